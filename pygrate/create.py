@@ -4,10 +4,15 @@ import subprocess
 import json
 import argparse
 import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
 from distutils.version import LooseVersion
 
 import xlsxwriter
 
+from pygrate import profiling
 from pygrate.common import SourceAction
 
 LOG = logging.getLogger(__name__)
@@ -18,12 +23,13 @@ def _get_tree_version():
     return LooseVersion(raw.decode('utf-8').split(' ')[1])
 
 
-def _read_tree_output(path, levels, file_limit):
+def _read_tree_output(path):
+    # the whole tree is read, levels and file limit are applied afterwards
+    # by collapsing directories so that their aggregates stay complete
     args = [
         'tree',
-        '-ugfhJ',
-        '-L', str(levels),
-        '--filelimit', str(file_limit),
+        '-ugfDJ',
+        '--timefmt', '%s',
         '--du',
         path
     ]
@@ -45,7 +51,7 @@ def _fix_error_messages(json_raw):
 
 def read_directory(path, levels, file_limit):
     """ Get the JSON representation of the provided path. """
-    LOG.info(f'Reading directory using tree with {levels} '
+    LOG.info(f'Reading directory using tree, collapsing beyond {levels} '
              f'level(s) and {file_limit} file-limit: {path}')
 
     tree_version = _get_tree_version()
@@ -55,7 +61,8 @@ def read_directory(path, levels, file_limit):
         raise Exception(
             'tree version too low to support json output. Please upgrade.')
 
-    json_raw = _read_tree_output(path, levels, file_limit)
+    with profiling.phase('tree'):
+        json_raw = _read_tree_output(path)
 
     # need to fix trailing , in JSON for tree version < 1.8.0
     if tree_version < LooseVersion('v1.8'):
@@ -64,20 +71,115 @@ def read_directory(path, levels, file_limit):
     # need to fix wrong tree error message
     json_raw = _fix_error_messages(json_raw)
 
-    res = json.loads(json_raw)
+    with profiling.phase('json.loads'):
+        res = json.loads(json_raw)
+
+    with profiling.phase('collapse_directories'):
+        res = collapse_directories(res, levels, file_limit)
 
     LOG.info(f'Completed reading directory: {path}')
     return res
 
 
+def _mtime(entry):
+    return int(entry.get('time', 0))
+
+
+def _summarize(entry):
+    """ Aggregate the content of a directory entry """
+    files = 0
+    newest = _mtime(entry)
+    types = Counter()
+
+    # depth first in listing order, so ties in the file types are stable
+    stack = list(reversed(entry.get('contents', [])))
+    while stack:
+        e = stack.pop()
+        newest = max(newest, _mtime(e))
+        if e['type'] == 'directory':
+            stack.extend(reversed(e.get('contents', [])))
+        else:
+            files += 1
+            types[os.path.splitext(e['name'])[1].lower() or '(none)'] += 1
+
+    return {
+        'files': files,
+        'newest': newest,
+        'types': types.most_common(3)
+    }
+
+
+def collapse_directories(data, levels, file_limit, depth=0):
+    """ Replace directories beyond the limits with an aggregate
+
+    Directories deeper than levels or with more than file_limit entries
+    lose their contents and get a summary of them in 'collapsed' instead.
+    """
+    res = []
+    for entry in data:
+        if entry['type'] == 'directory' and entry.get('contents'):
+            if depth >= levels or len(entry['contents']) > file_limit:
+                entry = dict(entry)
+                entry['collapsed'] = _summarize(entry)
+                del entry['contents']
+            else:
+                entry = dict(entry, contents=collapse_directories(
+                    entry['contents'], levels, file_limit, depth + 1))
+        res.append(entry)
+    return res
+
+
+def _format_size(size):
+    """ Human readable size in the style of tree -h """
+    if size < 1024:
+        return str(size)
+
+    for unit in 'KMGTPE':
+        size /= 1024
+        if size < 1024 or unit == 'E':
+            break
+    return f'{size:.1f}{unit}' if size < 10 else f'{size:.0f}{unit}'
+
+
 def create_excel(path):
     """ Create the workbook and worksheet """
+    wb, (ws,) = create_workbook(path, [path])
+    return wb, ws
+
+
+_INVALID_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+
+
+def _sheet_names(roots):
+    """ Unique and valid worksheet names for the scanned roots """
+    names = []
+    for root in roots:
+        base = _INVALID_SHEET_CHARS.sub('_', os.path.basename(
+            os.path.normpath(root))) or 'root'
+        name = base[:31]
+        i = 1
+        while name.lower() in (n.lower() for n in names):
+            i += 1
+            suffix = f' ({i})'
+            name = base[:31 - len(suffix)] + suffix
+        names.append(name)
+    return names
+
+
+def create_workbook(path, roots):
+    """ Create the workbook and a worksheet per scanned root
+
+    A single root keeps naming the worksheet after the workbook.
+    """
     LOG.info(f'Creating Excel workbook: {path}')
 
-    ws_name = os.path.basename(path)
+    if len(roots) == 1:
+        names = [os.path.basename(path)]
+    else:
+        names = _sheet_names(roots)
+
     wb = xlsxwriter.Workbook(path)
-    ws = wb.add_worksheet(ws_name)
-    return wb, ws
+    return wb, [wb.add_worksheet(name) for name in names]
 
 
 def _write_header(ws):
@@ -90,41 +192,50 @@ def _write_header(ws):
     ws.write(0, 4, 'Action')
     ws.write(0, 5, 'Target Location')
     ws.write(0, 6, 'Comment')
+    ws.write(0, 7, 'Collapsed: Files')
+    ws.write(0, 8, 'Collapsed: Newest Modification')
+    ws.write(0, 9, 'Collapsed: Main File Types')
 
 
-# BAAAAAAD globals...
-_OFFSET = 1
-
-
-def _write_rows(ws, data, indent=0):
-    global _OFFSET
-
+def _write_rows(ws, data, offset=1, indent=0):
+    """ Write the entries starting at row offset, returns the next free row """
     for entry in data:
         # skip the report part
         if entry['type'] == 'report':
             continue
 
-        ws.write(_OFFSET, 0, entry['name'])
+        profiling.count('create._write_rows')
+        ws.write(offset, 0, entry['name'])
         if 'user' in entry:
-            ws.write(_OFFSET, 1, entry['user'])
-            ws.write(_OFFSET, 2, entry['group'])
-            ws.write(_OFFSET, 3, entry['size'])
+            ws.write(offset, 1, entry['user'])
+            ws.write(offset, 2, entry['group'])
+            ws.write(offset, 3, _format_size(entry['size']))
+
+        if 'collapsed' in entry:
+            collapsed = entry['collapsed']
+            ws.write(offset, 7, collapsed['files'])
+            ws.write(offset, 8, datetime.fromtimestamp(
+                collapsed['newest']).strftime('%Y-%m-%d %H:%M'))
+            ws.write(offset, 9, ', '.join(
+                f'{ext} ({count})' for ext, count in collapsed['types']))
 
         # do we need to indent?
         if indent > 0:
-            ws.set_row(_OFFSET, options={'level': indent})
+            ws.set_row(offset, options={'level': indent})
 
-        _OFFSET += 1
+        offset += 1
 
         # recursive call
         if 'contents' in entry:
-            _write_rows(ws, entry['contents'], indent=indent + 1)
+            offset = _write_rows(ws, entry['contents'], offset, indent + 1)
+
+    return offset
 
 
-def _write_validations(ws):
+def _write_validations(ws, last_row):
     LOG.info('Writing validations...')
 
-    ws.data_validation(1, 4, _OFFSET, 4, {
+    ws.data_validation(1, 4, last_row, 4, {
         'validate': 'list',
         'source': list(map(str, SourceAction))
     })
@@ -133,27 +244,71 @@ def _write_validations(ws):
 def populate_sheet(ws, data):
     """ Write the values into the sheet """
     _write_header(ws)
-    _write_rows(ws, data)
-    _write_validations(ws)
+    last_row = _write_rows(ws, data)
+    _write_validations(ws, last_row)
+
+
+def _read_directory_profiled(path, levels, file_limit, profile):
+    """ Read a directory in a worker process, returning its profile as well """
+    if not profile:
+        return read_directory(path, levels, file_limit), None
+
+    profiling.PROFILER.start()
+    try:
+        data = read_directory(path, levels, file_limit)
+    finally:
+        profiling.PROFILER.stop()
+    return data, (profiling.PROFILER.phases, profiling.PROFILER.counts)
+
+
+def read_directories(paths, levels, file_limit, processes=None):
+    """ Read several directories concurrently in separate processes """
+    if len(paths) == 1:
+        return [read_directory(paths[0], levels, file_limit)]
+
+    LOG.info(f'Reading {len(paths)} directories concurrently')
+    with ProcessPoolExecutor(processes) as executor:
+        results = list(executor.map(
+            _read_directory_profiled, paths,
+            repeat(levels), repeat(file_limit),
+            repeat(profiling.PROFILER.enabled)))
+
+    # the phases of the worker processes are merged into this one
+    for _, profile in results:
+        if profile:
+            profiling.PROFILER.merge(*profile)
+    return [data for data, _ in results]
 
 
 def main():
     # parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('directory')
+    parser.add_argument('directories', nargs='+', metavar='directory')
     parser.add_argument('output')
     parser.add_argument('--levels', type=int, default=5)
     parser.add_argument('--file-limit', type=int, default=50)
+    parser.add_argument(
+        '--processes', type=int,
+        help='number of directories scanned at once, defaults to the CPU count')
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
     # configure logging
     logging.basicConfig(level=logging.INFO)
 
-    # process directories
-    data = read_directory(args.directory, args.levels, args.file_limit)
-    wb, ws = create_excel(args.output)
-    populate_sheet(ws, data)
-    wb.close()
+    with profiling.from_args(args):
+        # process directories, phases of concurrent scans are summed up
+        with profiling.phase('read_directories'):
+            data = read_directories(
+                args.directories, args.levels, args.file_limit, args.processes)
+
+        with profiling.phase('populate_sheet'):
+            wb, sheets = create_workbook(args.output, args.directories)
+            for ws, root_data in zip(sheets, data):
+                populate_sheet(ws, root_data)
+
+        with profiling.phase('save workbook'):
+            wb.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import logging
+import threading
+import multiprocessing
+from collections import Counter
+from pathlib import Path
+
+from pygrate import profiling
+from pygrate.migrate import Action, perform_actions, read_actions
+
+LOG = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    actions TEXT NOT NULL,
+    dry_run INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+)
+"""
+
+
+def shard_actions(actions):
+    """ Split actions into shards that can be performed independently
+
+    Actions end up in the same shard if any of their sources and targets
+    are equal or one lies inside the other, e.g. ignores and deletes inside
+    a move, two copies into the same target or a move into a directory that
+    is copied itself. Each shard is thereby a set of disjoint subtrees.
+    """
+    parent = {path: path for path in actions}
+
+    def find(path):
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    # index the actions by every path they touch
+    index = {}
+    for path, action in actions.items():
+        index.setdefault(path, []).append(path)
+        if action.target:
+            index.setdefault(action.target, []).append(path)
+
+    for node, owners in index.items():
+        for other in owners[1:]:
+            union(owners[0], other)
+
+        # the nearest indexed ancestor is enough as it is grouped further up
+        for p in node.parents:
+            if p in index:
+                union(owners[0], index[p][0])
+                break
+
+    shards = {}
+    for path in sorted(actions):
+        shards.setdefault(find(path), {})[path] = actions[path]
+
+    return list(shards.values())
+
+
+def _action_to_dict(action):
+    return {
+        'action': action.action.value,
+        'source': str(action.source),
+        'target': str(action.target) if action.target else None,
+        'priority': action.priority,
+    }
+
+
+def _action_from_dict(data):
+    target = Path(data['target']) if data['target'] else None
+    return Action(data['action'], Path(data['source']), target, data['priority'])
+
+
+def _connect(queue_path):
+    # autocommit mode, transactions are handled explicitly where needed
+    conn = sqlite3.connect(str(queue_path), timeout=60, isolation_level=None)
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def enqueue(queue_path, shards, dry_run=False):
+    """ Write the shards into the work queue
+
+    Finished shards of a previous plan are removed, so that the status of
+    the queue only reflects the new plan.
+    """
+    conn = _connect(queue_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        unfinished, = conn.execute(
+            'SELECT COUNT(*) FROM shards WHERE status IN (?, ?)',
+            (PENDING, RUNNING)).fetchone()
+        if unfinished:
+            conn.execute('ROLLBACK')
+            raise ValueError(
+                f'Queue contains {unfinished} unfinished shard(s): {queue_path}')
+
+        cursor = conn.execute(
+            'DELETE FROM shards WHERE status IN (?, ?)', (DONE, FAILED))
+        if cursor.rowcount:
+            LOG.info(f'Removed {cursor.rowcount} finished shard(s) of a previous plan')
+
+        conn.executemany(
+            'INSERT INTO shards (actions, dry_run) VALUES (?, ?)',
+            [
+                (json.dumps([_action_to_dict(a) for a in shard.values()]), int(dry_run))
+                for shard in shards
+            ])
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    LOG.info(f'Enqueued {len(shards)} shard(s) into {queue_path}')
+
+
+def queue_status(queue_path):
+    """ Get the number of shards per status """
+    conn = _connect(queue_path)
+    try:
+        return Counter(dict(conn.execute(
+            'SELECT status, COUNT(*) FROM shards GROUP BY status')))
+    finally:
+        conn.close()
+
+
+def _claim(conn, worker, lease, max_attempts):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+
+    # shards which repeatedly took down their worker are not tried again
+    cursor = conn.execute(
+        'UPDATE shards SET status = ?, error = ?, lease_expires = NULL '
+        'WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+        (FAILED, f'Lease expired after {max_attempts} attempt(s)',
+         RUNNING, now, max_attempts))
+    if cursor.rowcount:
+        LOG.warning(f'Marked {cursor.rowcount} shard(s) as failed after {max_attempts} attempt(s)')
+
+    row = conn.execute(
+        'SELECT id, actions, dry_run FROM shards '
+        'WHERE status = ? OR (status = ? AND lease_expires < ?) '
+        'ORDER BY id LIMIT 1',
+        (PENDING, RUNNING, now)).fetchone()
+    if row:
+        conn.execute(
+            'UPDATE shards SET status = ?, worker = ?, lease_expires = ?, '
+            'attempts = attempts + 1 WHERE id = ?',
+            (RUNNING, worker, now + lease, row[0]))
+    conn.execute('COMMIT')
+    return row
+
+
+def _has_running(conn):
+    count, = conn.execute(
+        'SELECT COUNT(*) FROM shards WHERE status = ?', (RUNNING,)).fetchone()
+    return count > 0
+
+
+def _renew_lease(queue_path, shard_id, worker, lease, stop, lost):
+    conn = _connect(queue_path)
+    try:
+        while not stop.wait(lease / 3):
+            try:
+                cursor = conn.execute(
+                    'UPDATE shards SET lease_expires = ? '
+                    'WHERE id = ? AND worker = ? AND status = ?',
+                    (time.time() + lease, shard_id, worker, RUNNING))
+            except sqlite3.OperationalError as e:
+                # e.g. the queue is locked, the lease is still valid for a while
+                LOG.warning(f'{worker} could not renew the lease on shard {shard_id}: {e}')
+                continue
+            if not cursor.rowcount:
+                LOG.warning(f'{worker} lost the lease on shard {shard_id}')
+                lost.set()
+                return
+    finally:
+        conn.close()
+
+
+def _finish(conn, shard_id, worker, status, error=None):
+    cursor = conn.execute(
+        'UPDATE shards SET status = ?, error = ?, lease_expires = NULL '
+        'WHERE id = ? AND worker = ?',
+        (status, error, shard_id, worker))
+    if not cursor.rowcount:
+        LOG.warning(f'Shard {shard_id} was taken over by another worker')
+        return False
+    return True
+
+
+def _perform_shard(queue_path, shard_id, actions_raw, dry_run, worker, lease):
+    actions = {}
+    for data in json.loads(actions_raw):
+        action = _action_from_dict(data)
+        actions[action.source] = action
+
+    # the remaining actions are left to the worker that took over the shard
+    stop = threading.Event()
+    lost = threading.Event()
+    heartbeat = threading.Thread(
+        target=_renew_lease,
+        args=(queue_path, shard_id, worker, lease, stop, lost),
+        daemon=True)
+    heartbeat.start()
+    try:
+        perform_actions(actions, dry_run=dry_run, abort=lost)
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def work(
+    queue_path,
+    worker=None,
+    lease=300,
+    poll_interval=5,
+    max_attempts=MAX_ATTEMPTS
+):
+    """ Claim and perform shards until the queue is drained
+
+    Shards of workers that stopped renewing their lease are claimed again
+    once the lease expired, up to max_attempts times before they are marked
+    as failed. Reclaimed shards are not idempotent: they run again against
+    whatever a previous attempt left behind, e.g. a partially moved target,
+    and fail rather than overwrite it. A worker that loses its lease stops
+    before its next action. Returns the number of shards per final status
+    performed by this worker.
+    """
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    LOG.info(f'Starting worker {worker} on {queue_path}')
+
+    results = Counter()
+    conn = _connect(queue_path)
+    try:
+        while True:
+            row = _claim(conn, worker, lease, max_attempts)
+            if row is None:
+                # wait for running shards, their lease might still expire
+                if not _has_running(conn):
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            shard_id, actions_raw, dry_run = row
+            LOG.info(f'{worker} claimed shard {shard_id}')
+            try:
+                with profiling.phase('perform shard'):
+                    _perform_shard(
+                        queue_path, shard_id, actions_raw, bool(dry_run), worker, lease)
+            except Exception as e:
+                LOG.exception(f'{worker} failed on shard {shard_id}')
+                if _finish(conn, shard_id, worker, FAILED, f'{type(e).__name__}: {e}'):
+                    results[FAILED] += 1
+            else:
+                if _finish(conn, shard_id, worker, DONE):
+                    results[DONE] += 1
+    finally:
+        conn.close()
+
+    LOG.info(f'Worker {worker} finished: {dict(results)}')
+    return results
+
+
+def coordinate(
+    workbook_path,
+    sheet_name,
+    queue_path,
+    dry_run=False,
+    processes=0,
+    all_sheets=False
+):
+    """ Shard the migration plan into the queue and optionally work on it
+
+    Workers on any host with access to the queue and the migrated paths can
+    be started with pygrate-worker. If processes is given, that many local
+    workers are started and the final queue status is returned.
+    """
+    actions = read_actions(workbook_path, sheet_name, all_sheets)
+    with profiling.phase('shard_actions'):
+        shards = shard_actions(actions)
+
+    enqueue(queue_path, shards, dry_run)
+
+    if processes:
+        return run_workers(queue_path, processes)
+    return queue_status(queue_path)
+
+
+def _work_process(queue_path, lease, poll_interval, max_attempts):
+    logging.basicConfig(level=logging.INFO)
+    work(queue_path, lease=lease, poll_interval=poll_interval, max_attempts=max_attempts)
+
+
+def run_workers(
+    queue_path,
+    processes,
+    lease=300,
+    poll_interval=5,
+    max_attempts=MAX_ATTEMPTS
+):
+    """ Start local worker processes and wait for them to drain the queue """
+    workers = [
+        multiprocessing.Process(
+            target=_work_process,
+            args=(str(queue_path), lease, poll_interval, max_attempts))
+        for _ in range(processes)
+    ]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    return queue_status(queue_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Perform shards of a migration plan from a shared queue')
+    parser.add_argument('queue')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--lease', type=int, default=300,
+                        help='seconds until a shard of an unresponsive worker is reclaimed')
+    parser.add_argument('--poll-interval', type=int, default=5)
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                        help='claims of a shard before it is marked as failed')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    # configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    with profiling.from_args(args):
+        if args.processes > 1:
+            status = run_workers(
+                args.queue, args.processes, args.lease, args.poll_interval,
+                args.max_attempts)
+        else:
+            work(args.queue, lease=args.lease, poll_interval=args.poll_interval,
+                 max_attempts=args.max_attempts)
+            status = queue_status(args.queue)
+
+    LOG.info(f'Queue status: {dict(status)}')
+    if status[FAILED]:
+        raise SystemExit(f'{status[FAILED]} shard(s) failed, see {args.queue}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,14 @@ import argparse
 import logging
 import shutil
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pathlib import Path
 
 from openpyxl import load_workbook
 from openpyxl.worksheet.worksheet import Worksheet, Cell
 
+from pygrate import profiling, transfer
 from pygrate.common import SourceAction
 
 
@@ -23,6 +25,12 @@ def read_migration_sheet(path, sheet_name=None):
     return sheet
 
 
+def read_migration_sheets(path):
+    """ Read all sheets of a workbook, e.g. one per scanned root """
+    wb = load_workbook(path)
+    return wb.worksheets
+
+
 class Action:
     def __init__(
         self,
@@ -50,6 +58,10 @@ class Action:
     def target_is_file(self):
         return self._target_is_file
 
+    @property
+    def ignored_sub_folders(self):
+        return tuple(self._ignore_sub_folders)
+
     def mark_target_as_file(self):
         self._target_is_file = True
     
@@ -74,7 +86,7 @@ class Action:
             else:
                 shutil.rmtree(str(self.source))
 
-    def _migrate_with_source_name(self, dry_run):
+    def _migrate_with_source_name(self, dry_run, links, created_dirs):
         a = Action(
             self.action,
             self.source,
@@ -88,9 +100,9 @@ class Action:
         for f in self._ignore_sub_folders:
             a.ignore_sub_folder(f)
 
-        a.perform(dry_run=dry_run)
+        a.perform(dry_run=dry_run, links=links, created_dirs=created_dirs)
 
-    def _migrate_elements(self, dry_run):
+    def _migrate_elements(self, dry_run, links, created_dirs):
         for entry in self.source.iterdir():
             if entry in self._ignore_sub_folders:
                 continue
@@ -106,9 +118,10 @@ class Action:
                 for path in self._ignore_sub_folders:
                     a.ignore_sub_folder(path)
             
-            a.perform(dry_run=dry_run)
+            a.perform(dry_run=dry_run, links=links, created_dirs=created_dirs)
 
-    def _migrate(self, func, dry_run):
+    @profiling.counted('Action._migrate')
+    def _migrate(self, func, dry_run, links, created_dirs):
         if self.target.exists() and not self.target.is_dir():
             raise IOError(f'Target exists: {self}')
 
@@ -120,35 +133,42 @@ class Action:
         if self.source.is_dir() and self.target.is_dir():
             # migrate all elements in source if names are the same
             if self.source.name.lower() == self.target.name.lower():
-                self._migrate_elements(dry_run)
+                # elements are migrated straight into the existing target
+                if created_dirs is not None:
+                    created_dirs.add(self.target)
+                self._migrate_elements(dry_run, links, created_dirs)
 
                 # clean up if moving things here
                 if self.action == SourceAction.MOVE and not dry_run:
                     self.source.rmdir()
             else:
-                self._migrate_with_source_name(dry_run)
+                self._migrate_with_source_name(dry_run, links, created_dirs)
 
         elif self.source.is_file() and not self.target_is_file:
-            self._migrate_with_source_name(dry_run)
+            self._migrate_with_source_name(dry_run, links, created_dirs)
 
         else:
             target_parent = self.target.parent
-            if not target_parent.exists():
-                if dry_run:
-                    LOG.info(f'Would create directory path: {target_parent}')
-                else:
-                    # parent does not exist, lets try and create it
-                    target_parent.mkdir(parents=True)
+            if created_dirs is None or target_parent not in created_dirs:
+                if not target_parent.exists():
+                    if dry_run:
+                        LOG.info(f'Would create directory path: {target_parent}')
+                    else:
+                        # parent does not exist, lets try and create it
+                        target_parent.mkdir(parents=True)
+
+                if created_dirs is not None:
+                    created_dirs.add(target_parent)
 
             if dry_run:
                 LOG.info(
                     f'Would use {func.__name__} to migrate {self.source} -> {self.target}')
             else:
                 LOG.debug(f'About to use {func}')
-                func(str(self.source), str(self.target))
+                func(str(self.source), str(self.target), links=links)
 
-    def _copy(self, dry_run):
-        func = shutil.copy2 if self.source.is_file() else shutil.copytree
+    def _copy(self, dry_run, links, created_dirs):
+        func = transfer.copy2 if self.source.is_file() else transfer.copytree
 
         def _ignore_sub_folder_callback(parent, contents):
             ignore = []
@@ -160,23 +180,30 @@ class Action:
         if self._ignore_sub_folders:
             LOG.debug(self._ignore_sub_folders)
             func = partial(func, ignore=_ignore_sub_folder_callback)
-            func.__name__ = shutil.copytree.__name__
+            func.__name__ = transfer.copytree.__name__
 
-        self._migrate(func, dry_run)
+        self._migrate(func, dry_run, links, created_dirs)
 
-    def _move(self, dry_run):
-        self._migrate(shutil.move, dry_run)
+    def _move(self, dry_run, links, created_dirs):
+        self._migrate(transfer.move, dry_run, links, created_dirs)
 
-    def perform(self, dry_run=False):
+    @profiling.counted('Action.perform')
+    def perform(self, dry_run=False, links=None, created_dirs=None):
+        """ Perform the action
+
+        links is shared between actions to recreate hardlinks at the target,
+        see transfer.copy2. created_dirs is a set of directories known to
+        exist, used to skip checking the parent of every single file.
+        """
         action_msg = 'dry-run' if dry_run else 'perform'
         LOG.info(f'About to {action_msg}: {self}')
 
         if self.action == SourceAction.DELETE:
             self._delete(dry_run)
         elif self.action == SourceAction.COPY:
-            self._copy(dry_run)
+            self._copy(dry_run, links, created_dirs)
         elif self.action == SourceAction.MOVE:
-            self._move(dry_run)
+            self._move(dry_run, links, created_dirs)
         elif self.action == SourceAction.IGNORE:
             LOG.info(f'Ignoring source: {self.source}')
         elif self.action == SourceAction.NOT_DEFINED:
@@ -190,39 +217,78 @@ class Action:
     __str__ = __repr__
 
 
-def sheet_to_actions(sheet: Worksheet):
+def sheet_rows(sheet: Worksheet):
+    """ Iterate over the path, action and target of each row """
     iter_ = sheet.iter_rows()
     next(iter_)  # skip header
 
-    # collect actions and paths
-    actions = {}
-    paths = []
     for row in iter_:
         path, _, _, _, action, target, *_ = map(lambda x: x.value, row)
+        yield Path(path), action, Path(target) if target else None
 
-        path = Path(path)
-        target = Path(target) if target else None
 
-        if target and not action:
-            raise ValueError(f'Target defined without action: {target}')
+def row_to_action(path, action, target):
+    """ Create the action of a row, None if the row has no action """
+    if target and not action:
+        raise ValueError(f'Target defined without action: {target}')
 
-        if action:
-            action_cls = Action(action, path, target, len(path.parents))
-            LOG.debug(f'Found action: {action_cls}')
+    if not action:
+        return None
+
+    action_cls = Action(action, path, target, len(path.parents))
+    LOG.debug(f'Found action: {action_cls}')
+    return action_cls
+
+
+def unaddressed_paths(paths, actions):
+    """ Paths neither addressed by an action nor by one of a parent """
+    return [
+        path for path in paths
+        if not any(p in actions for p in path.parents)
+    ]
+
+
+def sheet_to_actions(sheet: Worksheet):
+    # collect actions and paths
+    actions = {}
+    paths = []
+    for path, action, target in sheet_rows(sheet):
+        action_cls = row_to_action(path, action, target)
+        if action_cls:
             actions[path] = action_cls
         else:
             paths.append(path)
 
     # check if all paths are addressed
-    for path in paths:
-        has_parent_action = any(p in actions for p in path.parents)
+    for path in unaddressed_paths(paths, actions):
+        LOG.warning(f'{path} has no action')
+
+    return actions
 
-        if not has_parent_action:
-            LOG.warning(f'{path} has no action')
 
+def sheets_to_actions(sheets):
+    """ Combine the actions of several sheets into one plan """
+    actions = {}
+    for sheet in sheets:
+        for path, action in sheet_to_actions(sheet).items():
+            if path in actions:
+                raise ValueError(f'{path} is addressed in more than one sheet: {sheet.title}')
+            actions[path] = action
     return actions
 
 
+def read_actions(workbook_path, sheet_name=None, all_sheets=False):
+    """ Read the actions of a sheet, or of all sheets combined """
+    with profiling.phase('read_migration_sheet'):
+        if all_sheets:
+            sheets = read_migration_sheets(workbook_path)
+        else:
+            sheets = [read_migration_sheet(workbook_path, sheet_name)]
+
+    with profiling.phase('sheet_to_actions'):
+        return sheets_to_actions(sheets)
+
+
 def _prioritize_actions(actions):
     return sorted(actions.values(), key=lambda a: a.priority, reverse=True)
 
@@ -256,20 +322,89 @@ def _convert_encapsulated_actions(actions):
     return actions_modified
 
 
-def perform_actions(actions, dry_run=False):
-    actions = _convert_encapsulated_actions(actions)
-    actions = _prioritize_actions(actions)
+def _plan_target_directories(actions):
+    """ Collect the directories that need to exist before migrating """
+    directories = set()
+    reserved = set()
     for action in actions:
-        action.perform(dry_run=dry_run)
+        if action.action not in (SourceAction.COPY, SourceAction.MOVE):
+            continue
+
+        if action.source.is_dir():
+            directories.add(action.target.parent)
+            reserved.add(action.target)
+        elif not action.source.exists():
+            # the action fails anyway, do not leave directories behind for it
+            continue
+        elif action.target_is_file:
+            directories.add(action.target.parent)
+        else:
+            directories.add(action.target)
+
+    # targets of directory actions are created by the actions themselves,
+    # creating them upfront would change how the directory is migrated
+    return {
+        d for d in directories
+        if d not in reserved and not any(p in reserved for p in d.parents)
+    }
+
+
+def _create_target_directories(directories, dry_run=False):
+    """ Create directories level by level, each level in parallel """
+    levels = defaultdict(list)
+    for directory in directories:
+        levels[len(directory.parts)].append(directory)
+
+    with ThreadPoolExecutor() as executor:
+        for depth in sorted(levels):
+            level = sorted(levels[depth])
+            if dry_run:
+                for directory in level:
+                    if not directory.exists():
+                        LOG.info(f'Would create directory path: {directory}')
+            else:
+                LOG.info(f'Creating {len(level)} target directories at depth {depth}')
+                # consume the results to raise any errors
+                list(executor.map(
+                    partial(Path.mkdir, parents=True, exist_ok=True), level))
+
+    return set(directories)
+
+
+def plan_actions(actions):
+    """ Resolve encapsulated actions and order them for execution """
+    with profiling.phase('_convert_encapsulated_actions'):
+        actions = _convert_encapsulated_actions(actions)
+        return _prioritize_actions(actions)
+
+
+def perform_actions(actions, dry_run=False, abort=None):
+    """ Perform the planned actions in order
+
+    If abort is given, e.g. a threading.Event, it is checked before each
+    action and the remaining actions are skipped with an error once it is set.
+    """
+    actions = plan_actions(actions)
+
+    with profiling.phase('create target directories'):
+        created_dirs = _create_target_directories(
+            _plan_target_directories(actions), dry_run)
+
+    # hardlinks are tracked across actions so that each inode is copied once
+    links = {}
+    with profiling.phase('dry-run actions' if dry_run else 'perform actions'):
+        for action in actions:
+            if abort is not None and abort.is_set():
+                raise RuntimeError(f'Aborted before {action}')
+            action.perform(dry_run=dry_run, links=links, created_dirs=created_dirs)
 
 
 def dry_run_actions(actions):
     perform_actions(actions, dry_run=True)
 
 
-def migrate(workbook_path, sheet_name, dry_run=False):
-    sheet = read_migration_sheet(workbook_path, sheet_name)
-    actions = sheet_to_actions(sheet)
+def migrate(workbook_path, sheet_name, dry_run=False, all_sheets=False):
+    actions = read_actions(workbook_path, sheet_name, all_sheets)
     if dry_run:
         dry_run_actions(actions)
     else:
@@ -280,13 +415,40 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('workbook')
     parser.add_argument('--sheet')
+    parser.add_argument(
+        '--all-sheets', action='store_true',
+        help='combine the plans of all sheets into one migration')
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument(
+        '--queue',
+        help='shard the plan into this SQLite work queue for pygrate-worker')
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='number of local worker processes to start on the queue')
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.workers and not args.queue:
+        parser.error('--workers requires --queue')
+    if args.sheet and args.all_sheets:
+        parser.error('--sheet and --all-sheets are mutually exclusive')
+
     # configure logging
     logging.basicConfig(level=logging.INFO)
 
-    migrate(args.workbook, args.sheet, args.dry_run)
+    with profiling.from_args(args):
+        if args.queue:
+            # imported here as the distributed module builds on this one
+            from pygrate import distributed
+
+            status = distributed.coordinate(
+                args.workbook, args.sheet, args.queue, args.dry_run,
+                args.workers, args.all_sheets)
+            LOG.info(f'Queue status: {dict(status)}')
+            if status[distributed.FAILED]:
+                raise SystemExit(f'{status[distributed.FAILED]} shard(s) failed, see {args.queue}')
+        else:
+            migrate(args.workbook, args.sheet, args.dry_run, args.all_sheets)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+import cProfile
+import sys
+import time
+import tracemalloc
+import logging
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+LOG = logging.getLogger(__name__)
+
+
+class Profiler:
+    """ Records wall time and peak memory per phase and calls per hot path
+
+    The profiler is disabled by default, in which case phases and counters
+    are no-ops so they can stay in the code paths permanently.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = OrderedDict()
+        self.counts = Counter()
+        self._stack = []
+        self._profile = None
+        self._dump_path = None
+
+    def start(self, dump_path=None):
+        # a forked process inherits the state of its parent, start afresh
+        if self._profile:
+            self._profile.disable()
+            self._profile = None
+
+        self.enabled = True
+        self.phases.clear()
+        self.counts.clear()
+        self._stack.clear()
+        tracemalloc.start()
+
+        self._dump_path = dump_path
+        if dump_path:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(self._dump_path)
+            LOG.info(f'Written cProfile dump: {self._dump_path}')
+            self._profile = None
+
+        tracemalloc.stop()
+        self.enabled = False
+
+    def _reset_peak(self):
+        # reset_peak is only available from Python 3.9 on, before that the
+        # reported peak covers everything since the profiler was started
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        # keep the peak of an enclosing phase before resetting it
+        if self._stack:
+            self._stack[-1][1] = max(
+                self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+        self._reset_peak()
+
+        entry = [name, 0]
+        self._stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            peak = max(entry[1], tracemalloc.get_traced_memory()[1])
+
+            calls, total, max_peak = self.phases.get(name, (0, 0.0, 0))
+            self.phases[name] = (calls + 1, total + elapsed, max(max_peak, peak))
+
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+
+    def merge(self, phases, counts):
+        """ Add the phases and counts recorded by another process
+
+        Wall times of concurrent processes add up and may exceed the wall
+        time of the enclosing phase, peaks are those of a single process.
+        """
+        if not self.enabled:
+            return
+
+        for name, (calls, total, peak) in phases.items():
+            own_calls, own_total, own_peak = self.phases.get(name, (0, 0.0, 0))
+            self.phases[name] = (own_calls + calls, own_total + total, max(own_peak, peak))
+        self.counts.update(counts)
+
+    def count(self, name):
+        if self.enabled:
+            self.counts[name] += 1
+
+    def counted(self, name):
+        """ Decorator counting the calls of a hot path """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                self.count(name)
+                return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        lines = [f'{"Phase":<40} {"Calls":>8} {"Wall (s)":>10} {"Peak (MiB)":>11}']
+        for name, (calls, total, peak) in self.phases.items():
+            lines.append(
+                f'{name:<40} {calls:>8} {total:>10.3f} {peak / 2 ** 20:>11.1f}')
+
+        if self.counts:
+            lines.append('')
+            lines.append(f'{"Hot path":<40} {"Calls":>8}')
+            for name, calls in sorted(self.counts.items()):
+                lines.append(f'{name:<40} {calls:>8}')
+
+        return '\n'.join(lines)
+
+
+PROFILER = Profiler()
+
+phase = PROFILER.phase
+count = PROFILER.count
+counted = PROFILER.counted
+
+
+def add_arguments(parser):
+    """ Add the profiling options to a command line parser """
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='record time and peak memory per phase and print a summary')
+    parser.add_argument(
+        '--profile-dump', metavar='PATH',
+        help='also write a cProfile dump to PATH (implies --profile)')
+
+
+@contextmanager
+def from_args(args, stream=None):
+    """ Profile the enclosed block if requested and print the summary """
+    if not (args.profile or args.profile_dump):
+        yield PROFILER
+        return
+
+    PROFILER.start(args.profile_dump)
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.stop()
+        print(PROFILER.summary(), file=stream or sys.stderr)
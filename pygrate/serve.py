@@ -0,0 +1,559 @@
+import os
+import json
+import stat
+import argparse
+import logging
+import socketserver
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+from pygrate.common import SourceAction
+from pygrate.migrate import (
+    read_migration_sheet,
+    read_migration_sheets,
+    sheet_rows,
+    row_to_action,
+    unaddressed_paths,
+    plan_actions,
+    perform_actions
+)
+
+LOG = logging.getLogger(__name__)
+
+
+class _PathIndex:
+    """ Paths with their owners, with lookups of indexed ancestors and descendants """
+
+    def __init__(self):
+        self._owners = {}
+        # tree of the indexed paths and their ancestors
+        self._children = {}
+
+    def add(self, path, owner):
+        owners = self._owners.get(path)
+        if owners is None:
+            owners = self._owners[path] = set()
+            self._link(path)
+        owners.add(owner)
+
+    def remove(self, path, owner):
+        owners = self._owners.get(path)
+        if owners is None:
+            return
+
+        owners.discard(owner)
+        if not owners:
+            del self._owners[path]
+            self._unlink(path)
+
+    def _link(self, node):
+        # stop at the first ancestor already in the tree
+        while True:
+            parent = node.parent
+            if parent == node:
+                return
+            siblings = self._children.get(parent)
+            if siblings is not None:
+                siblings.add(node)
+                return
+            self._children[parent] = {node}
+            node = parent
+
+    def _unlink(self, node):
+        # drop nodes which neither are indexed nor have descendants
+        while node not in self._owners and not self._children.get(node):
+            self._children.pop(node, None)
+            parent = node.parent
+            if parent == node:
+                return
+            siblings = self._children.get(parent)
+            if siblings is None:
+                return
+            siblings.discard(node)
+            node = parent
+
+    def owners(self, path):
+        return self._owners.get(path, ())
+
+    def ancestors(self, path):
+        return [p for p in path.parents if p in self._owners]
+
+    def descendants(self, path):
+        res = set()
+        stack = list(self._children.get(path, ()))
+        while stack:
+            node = stack.pop()
+            if node in self._owners:
+                res.add(node)
+            stack.extend(self._children.get(node, ()))
+        return res
+
+
+@contextmanager
+def _capture_logs(name='pygrate'):
+    """ Collect the log messages of the package while in the block """
+    records = []
+    handler = logging.Handler(logging.INFO)
+    handler.emit = records.append
+
+    logger = logging.getLogger(name)
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        yield records
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+
+class PlanService:
+    """ Keeps a migration plan and filesystem metadata in memory
+
+    Rows edited through the service only live in memory, reloading the
+    workbook replaces them with its current content.
+    """
+
+    def __init__(self, workbook_path, sheet_name=None, all_sheets=False):
+        self.workbook_path = workbook_path
+        self.sheet_name = sheet_name
+        self.all_sheets = all_sheets
+
+        self.rows = {}
+        self.actions = {}
+        self._pending = set()
+        self._stats = {}
+
+        # sources of the actions, and sources plus targets for the subtrees
+        # that have to be dry run together (see distributed.shard_actions)
+        self._sources = _PathIndex()
+        self._paths = _PathIndex()
+
+        # actions not nested in another action with their impact totals
+        self._tops = set()
+        self._impact = {}
+
+        self.reload()
+
+    def _read_rows(self):
+        if self.all_sheets:
+            sheets = read_migration_sheets(self.workbook_path)
+        else:
+            sheets = [read_migration_sheet(self.workbook_path, self.sheet_name)]
+
+        rows = {}
+        for sheet in sheets:
+            for path, action, target in sheet_rows(sheet):
+                if path in rows:
+                    raise ValueError(f'{path} is addressed in more than one sheet: {sheet.title}')
+                rows[path] = (action, target)
+        return rows
+
+    def _invalidate(self, *paths):
+        for p in paths:
+            self._impact.pop(p, None)
+
+    def _add_action(self, action):
+        path = action.source
+        self.actions[path] = action
+        self._sources.add(path, path)
+        self._paths.add(path, path)
+        if action.target:
+            self._paths.add(action.target, path)
+
+        ancestors = self._sources.ancestors(path)
+        if ancestors:
+            self._invalidate(path, *ancestors)
+        else:
+            # a new top level action takes over the ones nested in it
+            descendants = self._sources.descendants(path)
+            self._invalidate(path, *descendants)
+            self._tops.add(path)
+            self._tops.difference_update(descendants)
+
+    def _remove_action(self, path):
+        action = self.actions.pop(path, None)
+        if not action:
+            return
+
+        self._invalidate(path, *self._sources.ancestors(path))
+        self._sources.remove(path, path)
+        self._paths.remove(path, path)
+        if action.target:
+            self._paths.remove(action.target, path)
+
+        if path in self._tops:
+            self._tops.discard(path)
+            for d in self._sources.descendants(path):
+                self._invalidate(d)
+                if not self._sources.ancestors(d):
+                    self._tops.add(d)
+
+    def _apply_row(self, path, row, action_cls):
+        self._remove_action(path)
+        self.rows[path] = row
+        if action_cls:
+            self._add_action(action_cls)
+
+    def _set_row(self, path, action, target):
+        self._apply_row(path, (action, target), row_to_action(path, action, target))
+
+    def reload(self):
+        """ Re-read the workbook and rebuild the actions of changed rows """
+        LOG.info(f'Loading migration plan: {self.workbook_path}')
+        rows = self._read_rows()
+
+        changed = {p for p, row in rows.items() if self.rows.get(p) != row}
+        removed = set(self.rows) - set(rows)
+
+        # build all actions first, so that an invalid row changes nothing
+        actions = {}
+        errors = []
+        for path in sorted(changed):
+            try:
+                actions[path] = row_to_action(path, *rows[path])
+            except ValueError as e:
+                errors.append(f'{path}: {e}')
+        if errors:
+            raise ValueError(f'Invalid rows in {self.workbook_path}: ' + '; '.join(errors))
+
+        for path in removed:
+            del self.rows[path]
+            self._remove_action(path)
+        for path, action_cls in actions.items():
+            self._apply_row(path, rows[path], action_cls)
+
+        self._pending |= changed | removed
+        LOG.info(f'{len(changed | removed)} row(s) changed')
+        return sorted(changed | removed)
+
+    def validate(self, rows):
+        """ Check edited rows against the plan and the filesystem """
+        errors = []
+        for path, action, target in rows:
+            try:
+                action_cls = row_to_action(path, action, target)
+            except ValueError as e:
+                errors.append((path, str(e)))
+                continue
+
+            if path not in self.rows:
+                errors.append((path, 'Path is not part of the migration plan'))
+            if not action_cls:
+                continue
+
+            if not os.path.lexists(path):
+                errors.append((path, 'Source does not exist'))
+            elif action_cls.action in (SourceAction.COPY, SourceAction.MOVE):
+                if target.exists() and not target.is_dir():
+                    errors.append((path, f'Target exists: {target}'))
+                elif path.is_dir() and action_cls.target_is_file:
+                    errors.append((path, f'Cannot migrate a directory to a file: {target}'))
+        return errors
+
+    def update(self, rows):
+        """ Apply edited rows if they are all valid """
+        errors = self.validate(rows)
+        if errors:
+            return errors
+
+        for path, action, target in rows:
+            self._set_row(path, action, target)
+            self._pending.add(path)
+        return []
+
+    def unaddressed(self):
+        return unaddressed_paths(
+            [p for p in self.rows if p not in self.actions], self.actions)
+
+    def refresh(self):
+        """ Drop the cached filesystem metadata """
+        self._stats.clear()
+        self._impact.clear()
+
+    def _tree_stats(self, path):
+        """ Number of files, bytes and unreadable directories below path
+
+        Unreadable directories are skipped with a warning. Results are
+        cached per directory.
+        """
+        if path in self._stats:
+            return self._stats[path]
+
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return 0, 0, 0
+
+        if not stat.S_ISDIR(st.st_mode):
+            return 1, st.st_size, 0
+
+        files, size, unreadable = 0, 0, 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        f, s, u = self._tree_stats(Path(entry.path))
+                    else:
+                        f, s, u = 1, entry.stat(follow_symlinks=False).st_size, 0
+                    files += f
+                    size += s
+                    unreadable += u
+        except OSError as e:
+            LOG.warning(f'Cannot read directory, skipping its contents: {e}')
+            unreadable += 1
+
+        self._stats[path] = (files, size, unreadable)
+        return files, size, unreadable
+
+    def _top_impact(self, top):
+        """ Impact totals of a top level action and the actions nested in it """
+        actions = {
+            p: self.actions[p]
+            for p in (top, *self._sources.descendants(top))
+        }
+        planned = plan_actions(actions)
+        by_source = {a.source: a for a in planned}
+
+        totals = {}
+        for action in planned:
+            stats = list(self._tree_stats(action.source))
+            for sub in action.ignored_sub_folders:
+                stats = [a - b for a, b in zip(stats, self._tree_stats(sub))]
+            totals[action.source] = [action.action, *stats]
+
+        # nested moves and deletes run first and take their subtree away
+        for action in planned:
+            if action.action not in (SourceAction.MOVE, SourceAction.DELETE):
+                continue
+            stats = self._tree_stats(action.source)
+            for parent in action.source.parents:
+                if parent in by_source:
+                    for i, value in enumerate(stats, 1):
+                        totals[parent][i] -= value
+                    if by_source[parent].action in (SourceAction.MOVE, SourceAction.DELETE):
+                        break
+
+        res = {}
+        for kind, files, size, unreadable in totals.values():
+            entry = res.setdefault(
+                kind.value, {'actions': 0, 'files': 0, 'bytes': 0, 'unreadable': 0})
+            entry['actions'] += 1
+            if kind is not SourceAction.IGNORE:
+                entry['files'] += files
+                entry['bytes'] += size
+                entry['unreadable'] += unreadable
+        return res
+
+    def impact(self):
+        """ Number of actions, files and bytes per kind of action """
+        res = {}
+        for top in self._tops:
+            if top not in self._impact:
+                self._impact[top] = self._top_impact(top)
+
+            for kind, totals in self._impact[top].items():
+                entry = res.setdefault(
+                    kind, {'actions': 0, 'files': 0, 'bytes': 0, 'unreadable': 0})
+                for key, value in totals.items():
+                    entry[key] += value
+        return res
+
+    def _shard(self, path):
+        """ Actions sharing a subtree with path, directly or via other actions """
+        shard = {}
+        seen = set()
+        frontier = [path]
+        while frontier:
+            node = frontier.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+
+            related = (node, *self._paths.ancestors(node), *self._paths.descendants(node))
+            for p in related:
+                for owner in self._paths.owners(p):
+                    if owner not in shard:
+                        action = self.actions[owner]
+                        shard[owner] = action
+                        frontier.append(action.source)
+                        if action.target:
+                            frontier.append(action.target)
+        return shard
+
+    def dry_run(self, paths=None):
+        """ Dry-run the subtrees of the given or the changed paths """
+        changed = set(self._pending if paths is None else paths)
+
+        shards = []
+        covered = set()
+        for path in sorted(changed):
+            if path in covered:
+                continue
+            shard = self._shard(path)
+            # shards are disjoint, a path without an action of its own (e.g.
+            # a cleared row) can lead to a shard that was already collected
+            if not shard or not covered.isdisjoint(shard):
+                continue
+            covered.update(shard)
+            shards.append(shard)
+
+        errors = []
+        with _capture_logs() as records:
+            for shard in shards:
+                try:
+                    perform_actions(shard, dry_run=True)
+                except (IOError, ValueError) as e:
+                    errors.append(str(e))
+
+        self._pending -= changed
+        return {
+            'actions': sum(len(s) for s in shards),
+            'log': [r.getMessage() for r in records],
+            'errors': errors
+        }
+
+
+def _parse_rows(body):
+    return [
+        (
+            Path(row['path']),
+            row.get('action'),
+            Path(row['target']) if row.get('target') else None
+        )
+        for row in body
+    ]
+
+
+def _errors_to_json(errors):
+    return [{'path': str(path), 'error': error} for path, error in errors]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def address_string(self):
+        # unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        LOG.info(f'{self.address_string()} {format % args}')
+
+    def _send(self, data, status=HTTPStatus.OK):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _dispatch(self, handler):
+        try:
+            handler(self.server.service)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send({'error': f'{type(e).__name__}: {e}'}, HTTPStatus.BAD_REQUEST)
+        except Exception as e:
+            LOG.exception(f'Failed to handle {self.command} {self.path}')
+            self._send({'error': f'{type(e).__name__}: {e}'}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def do_GET(self):
+        self._dispatch(self._get)
+
+    def do_POST(self):
+        self._dispatch(self._post)
+
+    def _get(self, service):
+        if self.path == '/plan':
+            self._send({
+                'workbook': str(service.workbook_path),
+                'rows': len(service.rows),
+                'actions': len(service.actions),
+                'unaddressed': sorted(map(str, service.unaddressed()))
+            })
+        elif self.path == '/impact':
+            self._send(service.impact())
+        else:
+            self._send({'error': f'Unknown path: {self.path}'}, HTTPStatus.NOT_FOUND)
+
+    def _post(self, service):
+        body = self._body()
+
+        if self.path == '/validate':
+            self._send({'errors': _errors_to_json(service.validate(_parse_rows(body)))})
+        elif self.path == '/rows':
+            errors = service.update(_parse_rows(body))
+            status = HTTPStatus.BAD_REQUEST if errors else HTTPStatus.OK
+            self._send({'errors': _errors_to_json(errors)}, status)
+        elif self.path == '/reload':
+            self._send({'changed': list(map(str, service.reload()))})
+        elif self.path == '/refresh':
+            service.refresh()
+            self._send({})
+        elif self.path == '/dry-run':
+            body = body or {}
+            paths = None
+            if body.get('all'):
+                paths = list(service.actions)
+            elif 'paths' in body:
+                paths = [Path(p) for p in body['paths']]
+            self._send(service.dry_run(paths))
+        else:
+            self._send({'error': f'Unknown path: {self.path}'}, HTTPStatus.NOT_FOUND)
+
+
+class _UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+
+def make_server(service, host='127.0.0.1', port=8642, socket_path=None):
+    """ Create the HTTP server for the service, on a unix socket if given
+
+    Requests are handled one after another, so the service needs no locking.
+    """
+    if socket_path:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = HTTPServer((host, port), _Handler)
+
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a migration plan for interactive validation')
+    parser.add_argument('workbook')
+    parser.add_argument('--sheet')
+    parser.add_argument('--all-sheets', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--socket', help='listen on this unix socket instead')
+    args = parser.parse_args()
+
+    # configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    service = PlanService(args.workbook, args.sheet, args.all_sheets)
+    server = make_server(service, args.host, args.port, args.socket)
+    LOG.info(f'Serving {args.workbook} on {args.socket or f"{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
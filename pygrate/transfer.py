@@ -0,0 +1,132 @@
+import errno
+import os
+import shutil
+import stat
+import logging
+from functools import partial
+
+from pygrate import profiling
+
+LOG = logging.getLogger(__name__)
+
+_BUFFER_SIZE = 1024 * 1024
+
+
+def _is_sparse(st):
+    """ Check if the allocated blocks cover less than the apparent size """
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return False
+    return blocks * 512 < st.st_size
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _copy_range(in_fd, out_fd, start, end):
+    os.lseek(in_fd, start, os.SEEK_SET)
+    os.lseek(out_fd, start, os.SEEK_SET)
+
+    remaining = end - start
+    while remaining > 0:
+        chunk = os.read(in_fd, min(_BUFFER_SIZE, remaining))
+        if not chunk:
+            break
+        _write_all(out_fd, chunk)
+        remaining -= len(chunk)
+
+
+def _copy_sparse(src, dst, size):
+    """ Copy only the data segments of src, leaving holes unwritten in dst """
+    with open(src, 'rb') as fsrc:
+        in_fd = fsrc.fileno()
+
+        # probe before creating the target so we can still fall back
+        try:
+            offset = os.lseek(in_fd, 0, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            offset = size  # file consists of a single hole
+
+        with open(dst, 'wb') as fdst:
+            out_fd = fdst.fileno()
+            while offset < size:
+                hole = os.lseek(in_fd, offset, os.SEEK_HOLE)
+                _copy_range(in_fd, out_fd, offset, hole)
+
+                try:
+                    offset = os.lseek(in_fd, hole, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    break  # only a trailing hole is left
+
+            os.ftruncate(out_fd, size)
+
+
+def _copy_data(src, dst, st):
+    if hasattr(os, 'SEEK_DATA') and _is_sparse(st):
+        try:
+            _copy_sparse(src, dst, st.st_size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            LOG.debug(f'Sparse copy not supported for {src}: {e}')
+
+    shutil.copyfile(src, dst)
+
+
+@profiling.counted('transfer.copy2')
+def copy2(src, dst, *, follow_symlinks=True, links=None):
+    """ Drop-in for shutil.copy2 which preserves hardlinks and holes
+
+    If links is a dict it maps the (st_dev, st_ino) of already copied
+    multiply-linked sources to their target path, so that further links
+    to the same inode are recreated as hardlinks instead of copies.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    if not follow_symlinks and os.path.islink(src):
+        return shutil.copy2(src, dst, follow_symlinks=False)
+
+    st = os.stat(src)
+    key = None
+    if links is not None and st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+        key = (st.st_dev, st.st_ino)
+        if key in links:
+            try:
+                os.link(links[key], dst)
+                profiling.count('transfer.copy2 relinked')
+                LOG.debug(f'Relinked {dst} to {links[key]}')
+                return dst
+            except OSError as e:
+                LOG.debug(f'Cannot relink {dst} to {links[key]}, copying: {e}')
+
+    _copy_data(src, dst, st)
+    shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
+
+    if key is not None and key not in links:
+        links[key] = dst
+    return dst
+
+
+def copytree(src, dst, ignore=None, links=None):
+    """ Recursively copy src to dst using the link and sparse aware copy2 """
+    if links is None:
+        links = {}
+    return shutil.copytree(
+        src, dst, ignore=ignore, copy_function=partial(copy2, links=links))
+
+
+def move(src, dst, links=None):
+    """ Move src to dst, using the link and sparse aware copy2 across devices """
+    if links is None:
+        links = {}
+    return shutil.move(src, dst, copy_function=partial(copy2, links=links))
@@ -10,7 +10,9 @@ setup(
     entry_points = {
         'console_scripts': [
             'pygrate-create=pygrate.create:main',
-            'pygrate-migrate=pygrate.migrate:main'
+            'pygrate-migrate=pygrate.migrate:main',
+            'pygrate-worker=pygrate.distributed:main',
+            'pygrate-serve=pygrate.serve:main'
         ],
     }
 )
\ No newline at end of file
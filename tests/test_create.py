@@ -0,0 +1,123 @@
+import multiprocessing
+
+import pytest
+from openpyxl import load_workbook
+
+from pygrate import create, profiling
+from pygrate.create import (
+    collapse_directories,
+    create_workbook,
+    populate_sheet,
+    read_directories,
+    _format_size,
+    _sheet_names
+)
+
+
+def _file(name, size, time):
+    return {'type': 'file', 'name': name, 'size': size, 'time': str(time)}
+
+
+def _directory(name, contents, time=0):
+    size = sum(e['size'] for e in contents) + 4096
+    return {'type': 'directory', 'name': name, 'size': size,
+            'time': str(time), 'contents': contents}
+
+
+def _example_tree():
+    return [
+        _directory('/root', [
+            _directory('/root/small', [_file('/root/small/a.txt', 10, 1)]),
+            _directory('/root/large', [
+                _file('/root/large/a.txt', 10, 1),
+                _file('/root/large/b.txt', 10, 5),
+                _file('/root/large/c.pdf', 10, 3),
+                _directory('/root/large/deep', [
+                    _file('/root/large/deep/README', 10, 9),
+                ]),
+            ]),
+        ]),
+        {'type': 'report', 'directories': 4, 'files': 5},
+    ]
+
+
+def test_collapse_directories_file_limit():
+    data = collapse_directories(_example_tree(), levels=5, file_limit=3)
+
+    small, large = data[0]['contents']
+    assert 'collapsed' not in small
+    assert 'contents' not in large
+    assert large['collapsed'] == {
+        'files': 4,
+        'newest': 9,
+        'types': [('.txt', 2), ('.pdf', 1), ('(none)', 1)],
+    }
+    assert large['size'] == 4 * 10 + 2 * 4096
+
+
+def test_collapse_directories_levels():
+    data = collapse_directories(_example_tree(), levels=1, file_limit=50)
+
+    small, large = data[0]['contents']
+    assert small['collapsed']['files'] == 1
+    assert large['collapsed']['files'] == 4
+    assert data[1]['type'] == 'report'
+
+
+def test_collapse_directories_keeps_input():
+    tree = _example_tree()
+    collapse_directories(tree, levels=1, file_limit=50)
+
+    assert 'contents' in tree[0]['contents'][1]
+
+
+def test_format_size():
+    assert _format_size(512) == '512'
+    assert _format_size(4096) == '4.0K'
+    assert _format_size(15 * 1024 ** 2) == '15M'
+
+
+def test_sheet_names():
+    roots = ['/shares/projects/', '/other/projects', '/shares/a:b', '/' + 'x' * 40]
+    assert _sheet_names(roots) == ['projects', 'projects (2)', 'a_b', 'x' * 31]
+
+
+def test_create_workbook_sheet_per_root(tmp_path):
+    output = tmp_path / 'plan.xlsx'
+    wb, sheets = create_workbook(str(output), ['/shares/one', '/shares/two'])
+    for ws in sheets:
+        populate_sheet(ws, collapse_directories(_example_tree(), 5, 50))
+    wb.close()
+
+    res = load_workbook(output)
+    assert res.sheetnames == ['one', 'two']
+    assert res['two'].max_row == 1 + 9
+
+
+def test_create_workbook_single_root(tmp_path):
+    output = tmp_path / 'plan.xlsx'
+    wb, _ = create_workbook(str(output), ['/shares/one'])
+    wb.close()
+
+    assert load_workbook(output).sheetnames == ['plan.xlsx']
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != 'fork',
+    reason='worker processes need to inherit the patched read_directory')
+def test_read_directories_merges_profiles(monkeypatch):
+    def _read_directory(path, levels, file_limit):
+        with profiling.phase('tree'):
+            profiling.count('tree output')
+        return _directory(path, [])
+    monkeypatch.setattr(create, 'read_directory', _read_directory)
+
+    profiling.PROFILER.start()
+    with profiling.phase('read_directories'):
+        data = read_directories(['/a', '/b', '/c'], 5, 50, processes=2)
+    profiling.PROFILER.stop()
+
+    assert [d['name'] for d in data] == ['/a', '/b', '/c']
+    assert profiling.PROFILER.phases['tree'][0] == 3
+    assert profiling.PROFILER.counts['tree output'] == 3
+    assert list(profiling.PROFILER.phases) == ['tree', 'read_directories']
@@ -0,0 +1,231 @@
+from pathlib import Path
+import sqlite3
+import time
+
+import pytest
+
+from pygrate.common import SourceAction
+from pygrate.distributed import (
+    shard_actions,
+    enqueue,
+    queue_status,
+    work,
+    run_workers,
+    _perform_shard,
+    DONE,
+    FAILED,
+    RUNNING
+)
+from pygrate.migrate import Action
+
+
+def _action(action, source, target=None):
+    source = Path(source)
+    target = Path(target) if target else None
+    return source, Action(action, source, target, len(source.parents))
+
+
+def test_shard_actions_at_subtree_boundaries():
+    actions = dict([
+        _action(SourceAction.MOVE, '/source/c/d', '/target/c/d'),
+        _action(SourceAction.DELETE, '/source/c/d/results/Thumbs.db'),
+        _action(SourceAction.COPY, '/source/c/e', '/target/c/e'),
+        _action(SourceAction.COPY, '/source/f.txt', '/target/c/e/f.txt'),
+        _action(SourceAction.IGNORE, '/source/a'),
+    ])
+
+    shards = shard_actions(actions)
+
+    assert sorted(sorted(map(str, shard)) for shard in shards) == [
+        ['/source/a'],
+        ['/source/c/d', '/source/c/d/results/Thumbs.db'],
+        ['/source/c/e', '/source/f.txt'],
+    ]
+
+
+def test_shard_actions_groups_equal_targets():
+    actions = dict([
+        _action(SourceAction.COPY, '/s1/data', '/t/data'),
+        _action(SourceAction.COPY, '/s2/data', '/t/data'),
+        _action(SourceAction.COPY, '/s3/data', '/u/data'),
+    ])
+
+    shards = shard_actions(actions)
+
+    assert sorted(sorted(map(str, shard)) for shard in shards) == [
+        ['/s1/data', '/s2/data'],
+        ['/s3/data'],
+    ]
+
+
+def test_shard_actions_groups_sources_and_targets():
+    actions = dict([
+        _action(SourceAction.MOVE, '/x/a', '/y/b/a'),
+        _action(SourceAction.COPY, '/y/b', '/z'),
+        _action(SourceAction.MOVE, '/v/c', '/w'),
+        _action(SourceAction.COPY, '/w/d', '/q'),
+    ])
+
+    shards = shard_actions(actions)
+
+    assert sorted(sorted(map(str, shard)) for shard in shards) == [
+        ['/v/c', '/w/d'],
+        ['/x/a', '/y/b'],
+    ]
+
+
+def _create_shares(tmp_path, count):
+    actions = {}
+    for i in range(count):
+        source = tmp_path / 'source' / f'share-{i}'
+        (source / 'data').mkdir(parents=True)
+        (source / 'data' / 'file.txt').write_text(str(i))
+        (source / 'Thumbs.db').write_text('')
+
+        target = tmp_path / 'target' / f'share-{i}'
+        actions[source] = Action(SourceAction.MOVE, source, target, len(source.parents))
+        actions[source / 'Thumbs.db'] = Action(
+            SourceAction.DELETE, source / 'Thumbs.db', priority=len(source.parents) + 1)
+    return actions
+
+
+def test_work_drains_queue(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 3)
+    enqueue(queue, shard_actions(actions))
+
+    results = work(queue, worker='test')
+
+    assert results[DONE] == 3
+    assert queue_status(queue)[DONE] == 3
+    for i in range(3):
+        assert (tmp_path / 'target' / f'share-{i}' / 'data' / 'file.txt').read_text() == str(i)
+        assert not (tmp_path / 'target' / f'share-{i}' / 'Thumbs.db').exists()
+        assert not (tmp_path / 'source' / f'share-{i}').exists()
+
+
+def test_work_dry_run(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 2)
+    enqueue(queue, shard_actions(actions), dry_run=True)
+
+    work(queue, worker='test')
+
+    assert queue_status(queue)[DONE] == 2
+    assert not (tmp_path / 'target').exists()
+
+
+def test_work_records_failures(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 2)
+    (tmp_path / 'target' / 'share-0').parent.mkdir()
+    (tmp_path / 'target' / 'share-0').write_text('')
+    enqueue(queue, shard_actions(actions))
+
+    results = work(queue, worker='test')
+
+    assert results[FAILED] == 1
+    assert results[DONE] == 1
+
+
+def test_enqueue_refuses_unfinished_queue(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 1)
+    enqueue(queue, shard_actions(actions))
+
+    with pytest.raises(ValueError):
+        enqueue(queue, shard_actions(actions))
+
+
+def test_enqueue_replaces_finished_plan(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 1)
+    (tmp_path / 'target').mkdir()
+    (tmp_path / 'target' / 'share-0').write_text('')
+    enqueue(queue, shard_actions(actions))
+    work(queue, worker='test')
+    assert queue_status(queue) == {FAILED: 1}
+
+    # the delete inside the move already ran before the move failed
+    (tmp_path / 'target' / 'share-0').unlink()
+    (tmp_path / 'source' / 'share-0' / 'Thumbs.db').write_text('')
+    enqueue(queue, shard_actions(actions))
+
+    assert work(queue, worker='test') == {DONE: 1}
+    assert queue_status(queue) == {DONE: 1}
+
+
+def test_work_reclaims_expired_lease(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 1)
+    enqueue(queue, shard_actions(actions))
+
+    # simulate a worker that died while holding the shard
+    with sqlite3.connect(str(queue)) as conn:
+        conn.execute(
+            'UPDATE shards SET status = ?, worker = ?, lease_expires = ?',
+            (RUNNING, 'dead', time.time() + 0.5))
+
+    results = work(queue, worker='test', poll_interval=0.1)
+
+    assert results[DONE] == 1
+    assert (tmp_path / 'target' / 'share-0' / 'data' / 'file.txt').exists()
+
+
+def test_perform_shard_aborts_after_lost_lease(tmp_path, monkeypatch):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 1)
+    enqueue(queue, shard_actions(actions))
+    with sqlite3.connect(str(queue)) as conn:
+        shard_id, actions_raw = conn.execute('SELECT id, actions FROM shards').fetchone()
+        conn.execute(
+            'UPDATE shards SET status = ?, worker = ?, lease_expires = ?',
+            (RUNNING, 'test', time.time() + 0.3))
+
+    perform = Action.perform
+
+    # another worker takes over the shard while the first action runs
+    def _perform(self, *args, **kwargs):
+        with sqlite3.connect(str(queue)) as conn:
+            conn.execute('UPDATE shards SET worker = ?', ('other',))
+        time.sleep(0.3)
+        return perform(self, *args, **kwargs)
+    monkeypatch.setattr(Action, 'perform', _perform)
+
+    with pytest.raises(RuntimeError):
+        _perform_shard(queue, shard_id, actions_raw, False, 'test', 0.3)
+
+    # the delete ran, the move is left to the other worker
+    assert not (tmp_path / 'source' / 'share-0' / 'Thumbs.db').exists()
+    assert (tmp_path / 'source' / 'share-0' / 'data').exists()
+    assert not (tmp_path / 'target' / 'share-0').exists()
+
+
+def test_work_fails_shard_after_max_attempts(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 1)
+    enqueue(queue, shard_actions(actions))
+
+    # simulate a shard that took down its worker on every attempt
+    with sqlite3.connect(str(queue)) as conn:
+        conn.execute(
+            'UPDATE shards SET status = ?, worker = ?, lease_expires = ?, attempts = ?',
+            (RUNNING, 'dead', time.time() - 1, 2))
+
+    results = work(queue, worker='test', max_attempts=2)
+
+    assert results == {}
+    assert queue_status(queue) == {FAILED: 1}
+    assert (tmp_path / 'source' / 'share-0').exists()
+
+
+def test_run_workers(tmp_path):
+    queue = tmp_path / 'queue.sqlite'
+    actions = _create_shares(tmp_path, 8)
+    enqueue(queue, shard_actions(actions))
+
+    status = run_workers(queue, 3, poll_interval=0.1)
+
+    assert status == {DONE: 8}
+    for i in range(8):
+        assert (tmp_path / 'target' / f'share-{i}' / 'data' / 'file.txt').exists()
@@ -3,14 +3,17 @@ import os
 import logging
 
 import pytest
+from openpyxl import Workbook
 
 from pygrate.common import SourceAction
 from pygrate.migrate import (
     read_migration_sheet,
     sheet_to_actions,
+    sheets_to_actions,
     perform_actions,
     dry_run_actions,
-    Action
+    Action,
+    _plan_target_directories
 )
 
 
@@ -245,6 +248,10 @@ def test_perform_actions_missing_source(example_migration_sheet, fs):
     with pytest.raises(IOError):
         perform_actions(actions)
 
+    # only the directories of actions with an existing source are created
+    assert os.path.isdir('/target-directory/c')
+    assert not os.path.exists('/target-directory/c/e')
+
 
 def test_perform_actions_existing_target(example_migration_sheet, fs):
     _mock_directory_structure(fs)
@@ -321,3 +328,85 @@ def test_encapsulated_ignore(fs):
     assert target_path.exists()
     assert Path('/target/source/encapsulated').exists()
     assert not Path('/target/source/encapsulated/directory').exists()
+
+
+def test_plan_target_directories(fs):
+    fs.create_file('/source/file.txt')
+    fs.create_file('/source/no-suffix')
+
+    actions = [
+        Action(SourceAction.COPY, Path('/source/file.txt'), Path('/target/a/file.txt')),
+        Action(SourceAction.MOVE, Path('/source/no-suffix'), Path('/target/b')),
+        Action(SourceAction.DELETE, Path('/source/removed.txt')),
+    ]
+
+    assert _plan_target_directories(actions) == {Path('/target/a'), Path('/target/b')}
+
+
+def test_plan_target_directories_skips_directory_targets(fs):
+    fs.create_dir('/source/directory')
+    fs.create_file('/source/file.txt')
+
+    actions = [
+        Action(SourceAction.COPY, Path('/source/directory'), Path('/target/new')),
+        Action(SourceAction.COPY, Path('/source/file.txt'), Path('/target/new/file.txt')),
+    ]
+
+    assert _plan_target_directories(actions) == {Path('/target')}
+
+
+def test_plan_target_directories_skips_missing_sources(fs):
+    fs.create_file('/source/file.txt')
+
+    actions = [
+        Action(SourceAction.COPY, Path('/source/file.txt'), Path('/target/a/file.txt')),
+        Action(SourceAction.COPY, Path('/source/missing.txt'), Path('/target/b/missing.txt')),
+        Action(SourceAction.MOVE, Path('/source/missing'), Path('/target/c')),
+    ]
+
+    assert _plan_target_directories(actions) == {Path('/target/a')}
+
+
+def test_perform_actions_creates_target_directories(fs):
+    fs.create_file('/source/one.txt')
+    fs.create_file('/source/two.txt')
+
+    actions = {
+        Path('/source/one.txt'): Action(SourceAction.COPY, Path('/source/one.txt'), Path('/target/a/b/one.txt'), 2),
+        Path('/source/two.txt'): Action(SourceAction.COPY, Path('/source/two.txt'), Path('/target/c'), 2),
+    }
+    perform_actions(actions)
+
+    assert Path('/target/a/b/one.txt').is_file()
+    assert Path('/target/c/two.txt').is_file()
+
+
+def _sheet(wb, title, rows):
+    ws = wb.create_sheet(title)
+    ws.append(['Folder/File', 'Owner: User', 'Owner: Group', 'Size', 'Action', 'Target Location'])
+    for path, action, target in rows:
+        ws.append([path, None, None, None, action, target])
+    return ws
+
+
+def test_sheets_to_actions():
+    wb = Workbook()
+    sheets = [
+        _sheet(wb, 'one', [('/one', 'Copy', '/target')]),
+        _sheet(wb, 'two', [('/two', 'Move', '/target'), ('/two/tmp', 'Delete', None)]),
+    ]
+
+    actions = sheets_to_actions(sheets)
+
+    assert set(actions) == {Path('/one'), Path('/two'), Path('/two/tmp')}
+
+
+def test_sheets_to_actions_duplicate_path():
+    wb = Workbook()
+    sheets = [
+        _sheet(wb, 'one', [('/one', 'Copy', '/target')]),
+        _sheet(wb, 'two', [('/one', 'Delete', None)]),
+    ]
+
+    with pytest.raises(ValueError):
+        sheets_to_actions(sheets)
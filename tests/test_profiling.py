@@ -0,0 +1,91 @@
+import argparse
+import io
+import pstats
+
+from pygrate.profiling import Profiler, PROFILER, add_arguments, from_args
+
+
+def test_profiler_disabled_is_noop():
+    profiler = Profiler()
+
+    with profiler.phase('phase'):
+        profiler.count('hot path')
+
+    assert not profiler.phases
+    assert not profiler.counts
+
+
+def test_profiler_records_phases_and_counts():
+    profiler = Profiler()
+    profiler.start()
+
+    with profiler.phase('outer'):
+        with profiler.phase('inner'):
+            data = [0] * 100000
+        del data
+
+    with profiler.phase('inner'):
+        pass
+
+    for _ in range(3):
+        profiler.count('hot path')
+    profiler.stop()
+
+    calls, wall, peak = profiler.phases['inner']
+    assert calls == 2
+    assert wall >= 0
+    assert peak > 0
+    # the peak of the enclosed phase counts for the enclosing one as well
+    assert profiler.phases['outer'][2] >= peak
+    assert profiler.counts['hot path'] == 3
+
+    summary = profiler.summary()
+    assert 'outer' in summary
+    assert 'hot path' in summary
+
+
+def test_profiler_merges_other_processes():
+    profiler = Profiler()
+    profiler.start()
+    with profiler.phase('tree'):
+        pass
+    profiler.count('hot path')
+
+    profiler.merge({'tree': (2, 1.5, 100), 'json.loads': (1, 0.5, 50)}, {'hot path': 2})
+    profiler.stop()
+
+    calls, wall, peak = profiler.phases['tree']
+    assert calls == 3
+    assert wall >= 1.5
+    assert peak >= 100
+    assert profiler.phases['json.loads'] == (1, 0.5, 50)
+    assert profiler.counts['hot path'] == 3
+
+
+def test_from_args_prints_summary_and_dumps(tmp_path):
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    dump = tmp_path / 'profile.out'
+    args = parser.parse_args(['--profile-dump', str(dump)])
+
+    stream = io.StringIO()
+    with from_args(args, stream=stream):
+        with PROFILER.phase('work'):
+            sum(range(1000))
+
+    assert not PROFILER.enabled
+    assert 'work' in stream.getvalue()
+    assert pstats.Stats(str(dump)).total_calls > 0
+
+
+def test_from_args_without_profile():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args([])
+
+    stream = io.StringIO()
+    with from_args(args, stream=stream):
+        pass
+
+    assert not PROFILER.enabled
+    assert stream.getvalue() == ''
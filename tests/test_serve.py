@@ -0,0 +1,245 @@
+import json
+import os
+from pathlib import Path
+import threading
+import urllib.request
+
+import pytest
+from openpyxl import Workbook
+
+from pygrate.serve import PlanService, make_server
+
+
+@pytest.fixture
+def plan(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'a' / 'nested').mkdir(parents=True)
+    (source / 'a' / 'one.txt').write_bytes(b'x' * 10)
+    (source / 'a' / 'nested' / 'two.txt').write_bytes(b'x' * 20)
+    (source / 'b').mkdir()
+    (source / 'b' / 'three.txt').write_bytes(b'x' * 30)
+    (tmp_path / 'target').mkdir()
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Folder/File', 'Owner: User', 'Owner: Group', 'Size', 'Action', 'Target Location'])
+    ws.append([str(source), None, None, None, None, None])
+    ws.append([str(source / 'a'), None, None, None, 'Move', str(tmp_path / 'target')])
+    ws.append([str(source / 'a' / 'nested'), None, None, None, 'Ignore', None])
+    ws.append([str(source / 'b'), None, None, None, 'Copy', str(tmp_path / 'target')])
+
+    path = tmp_path / 'plan.xlsx'
+    wb.save(path)
+    return path
+
+
+def test_service_impact(plan, tmp_path):
+    service = PlanService(plan)
+
+    impact = service.impact()
+
+    # the ignored folder inside the move is deleted before moving
+    assert impact['Move'] == {'actions': 1, 'files': 1, 'bytes': 10, 'unreadable': 0}
+    assert impact['Delete'] == {'actions': 1, 'files': 1, 'bytes': 20, 'unreadable': 0}
+    assert impact['Copy'] == {'actions': 1, 'files': 1, 'bytes': 30, 'unreadable': 0}
+
+
+def test_service_impact_unreadable_directory(plan, tmp_path, monkeypatch):
+    locked = tmp_path / 'source' / 'b' / 'locked'
+    locked.mkdir()
+    (locked / 'hidden.txt').write_text('x')
+
+    scandir = os.scandir
+
+    def _scandir(path):
+        if Path(path) == locked:
+            raise PermissionError(13, 'Permission denied', str(path))
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', _scandir)
+
+    impact = PlanService(plan).impact()
+
+    assert impact['Copy'] == {'actions': 1, 'files': 1, 'bytes': 30, 'unreadable': 1}
+
+
+def test_server_unexpected_error(plan, monkeypatch):
+    service = PlanService(plan)
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def _fail():
+        raise RuntimeError('boom')
+    monkeypatch.setattr(service, 'impact', _fail)
+    try:
+        status, res = _request(server.server_address[1], '/impact')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert status == 500
+    assert 'boom' in res['error']
+
+
+def test_service_validate(plan, tmp_path):
+    service = PlanService(plan)
+    (tmp_path / 'target' / 'file.txt').write_text('')
+
+    errors = service.validate([
+        (tmp_path / 'source' / 'b', 'Copy', tmp_path / 'target' / 'file.txt'),
+        (tmp_path / 'source' / 'a', None, tmp_path / 'target'),
+        (tmp_path / 'unknown', 'Delete', None),
+        (tmp_path / 'source', 'Delete', None),
+    ])
+
+    assert [path for path, _ in errors] == [
+        tmp_path / 'source' / 'b',
+        tmp_path / 'source' / 'a',
+        tmp_path / 'unknown',
+        tmp_path / 'unknown',
+    ]
+
+
+def test_service_incremental_dry_run(plan, tmp_path):
+    service = PlanService(plan)
+    service.dry_run()
+
+    assert service.update([(tmp_path / 'source' / 'b', 'Delete', None)]) == []
+    res = service.dry_run()
+
+    assert res['actions'] == 1
+    assert res['errors'] == []
+    assert any('source/b' in line for line in res['log'])
+    assert not any('source/a' in line for line in res['log'])
+    assert (tmp_path / 'source' / 'b').exists()
+
+    assert service.dry_run()['actions'] == 0
+
+
+def test_service_dry_run_cleared_and_edited_rows(plan, tmp_path):
+    service = PlanService(plan)
+    service.dry_run()
+
+    assert service.update([
+        (tmp_path / 'source' / 'a', 'Copy', tmp_path / 'target'),
+        (tmp_path / 'source' / 'a' / 'nested', None, None),
+    ]) == []
+    res = service.dry_run()
+
+    # the copy of b into the same target shares the shard, each runs once
+    assert res['actions'] == 2
+    started = [line for line in res['log'] if line.startswith('About to dry-run')]
+    assert len(started) == len(set(started))
+
+
+def _fresh_service(service, tmp_path):
+    """ Load the rows of a service, including its edits, into a new one """
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Folder/File', 'Owner: User', 'Owner: Group', 'Size', 'Action', 'Target Location'])
+    for path, (action, target) in service.rows.items():
+        ws.append([str(path), None, None, None, action, str(target) if target else None])
+
+    path = tmp_path / 'fresh.xlsx'
+    wb.save(path)
+    return PlanService(path)
+
+
+def test_service_incremental_impact(plan, tmp_path):
+    service = PlanService(plan)
+    service.impact()
+
+    edits = [
+        # nest everything in a new top level move
+        (tmp_path / 'source', 'Move', tmp_path / 'target'),
+        (tmp_path / 'source' / 'a', None, None),
+        (tmp_path / 'source', None, None),
+        (tmp_path / 'source' / 'a', 'Copy', tmp_path / 'target'),
+    ]
+    for edit in edits:
+        assert service.update([edit]) == []
+        assert service.impact() == _fresh_service(service, tmp_path).impact()
+
+    assert service.impact()['Copy'] == {'actions': 2, 'files': 2, 'bytes': 40, 'unreadable': 0}
+
+
+def test_service_dry_run_shares_subtrees(plan, tmp_path):
+    service = PlanService(plan)
+    service.dry_run()
+
+    # the copy into the target of the move has to be dry run together with it
+    service.update([(tmp_path / 'source' / 'b', 'Copy', tmp_path / 'target' / 'a')])
+    res = service.dry_run()
+
+    assert res['actions'] == 3
+
+
+def test_service_reload(plan, tmp_path):
+    service = PlanService(plan)
+    assert service.unaddressed() == [tmp_path / 'source']
+
+    service.update([(tmp_path / 'source', 'Ignore', None)])
+    assert service.unaddressed() == []
+
+    # edits are replaced by the content of the workbook
+    assert service.reload() == [tmp_path / 'source']
+    assert service.unaddressed() == [tmp_path / 'source']
+
+
+def test_service_reload_invalid_rows_change_nothing(plan, tmp_path):
+    service = PlanService(plan)
+    service.dry_run()
+    rows = dict(service.rows)
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Folder/File', 'Owner: User', 'Owner: Group', 'Size', 'Action', 'Target Location'])
+    ws.append([str(tmp_path / 'source'), None, None, None, 'Ignore', None])
+    ws.append([str(tmp_path / 'source' / 'a'), None, None, None, None, str(tmp_path / 'target')])
+    ws.append([str(tmp_path / 'source' / 'b'), None, None, None, 'Delete', None])
+    wb.save(plan)
+
+    with pytest.raises(ValueError):
+        service.reload()
+
+    assert service.rows == rows
+    assert set(service.actions) == {p for p, (action, _) in rows.items() if action}
+    assert service.dry_run()['actions'] == 0
+
+
+def _request(port, path, data=None):
+    body = json.dumps(data).encode('utf-8') if data is not None else None
+    req = urllib.request.Request(
+        f'http://127.0.0.1:{port}{path}', data=body,
+        method='POST' if body is not None else 'GET')
+    try:
+        with urllib.request.urlopen(req) as res:
+            return res.status, json.loads(res.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server(plan, tmp_path):
+    server = make_server(PlanService(plan), port=0)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        status, res = _request(port, '/plan')
+        assert status == 200
+        assert res['actions'] == 3
+
+        status, res = _request(port, '/rows', [
+            {'path': str(tmp_path / 'source' / 'b'), 'action': 'Copy'}])
+        assert status == 400
+        assert len(res['errors']) == 1
+
+        status, res = _request(port, '/dry-run', {'all': True})
+        assert status == 200
+        assert res['actions'] == 3
+
+        status, _ = _request(port, '/unknown')
+        assert status == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,83 @@
+from pathlib import Path
+import os
+
+import pytest
+
+from pygrate.common import SourceAction
+from pygrate.migrate import Action, perform_actions
+from pygrate.transfer import copy2, copytree, move
+
+
+def _same_file(a, b):
+    return os.stat(a).st_ino == os.stat(b).st_ino
+
+
+def test_copytree_preserves_hardlinks(fs):
+    fs.create_file('/source/a.txt', contents='linked')
+    os.link('/source/a.txt', '/source/b.txt')
+    fs.create_file('/source/c.txt', contents='single')
+
+    copytree('/source', '/target')
+
+    assert Path('/target/b.txt').read_text() == 'linked'
+    assert _same_file('/target/a.txt', '/target/b.txt')
+    assert not _same_file('/target/a.txt', '/source/a.txt')
+    assert not _same_file('/target/a.txt', '/target/c.txt')
+
+
+def test_copy2_without_links_copies(fs):
+    fs.create_file('/source/a.txt', contents='linked')
+    os.link('/source/a.txt', '/source/b.txt')
+    fs.create_dir('/target')
+
+    copy2('/source/a.txt', '/target')
+    copy2('/source/b.txt', '/target')
+
+    assert not _same_file('/target/a.txt', '/target/b.txt')
+
+
+def test_hardlinks_preserved_across_actions(fs):
+    fs.create_file('/source/one/a.txt', contents='linked')
+    fs.create_dir('/source/two')
+    os.link('/source/one/a.txt', '/source/two/b.txt')
+    fs.create_dir('/target')
+
+    actions = {
+        Path('/source/one'): Action(SourceAction.COPY, Path('/source/one'), Path('/target'), 2),
+        Path('/source/two'): Action(SourceAction.COPY, Path('/source/two'), Path('/target'), 2),
+    }
+    perform_actions(actions)
+
+    assert _same_file('/target/one/a.txt', '/target/two/b.txt')
+
+
+def test_move_across_devices_preserves_hardlinks(fs):
+    fs.add_mount_point('/mnt')
+    fs.create_file('/source/a.txt', contents='linked')
+    os.link('/source/a.txt', '/source/b.txt')
+
+    move('/source', '/mnt/target')
+
+    assert not os.path.exists('/source')
+    assert _same_file('/mnt/target/a.txt', '/mnt/target/b.txt')
+
+
+@pytest.mark.skipif(not hasattr(os, 'SEEK_DATA'), reason='SEEK_DATA not supported')
+def test_copy2_keeps_holes(tmp_path):
+    source = tmp_path / 'sparse.img'
+    size = 64 * 1024 * 1024
+    with open(source, 'wb') as f:
+        f.write(b'head')
+        f.seek(size // 2)
+        f.write(b'middle')
+        f.truncate(size)
+
+    if os.stat(source).st_blocks * 512 >= size:
+        pytest.skip('filesystem does not support sparse files')
+
+    target = tmp_path / 'copy.img'
+    copy2(str(source), str(target))
+
+    assert target.stat().st_size == size
+    assert target.read_bytes() == source.read_bytes()
+    assert target.stat().st_blocks * 512 < size